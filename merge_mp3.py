@@ -1,8 +1,20 @@
 import os
 import re
+import subprocess
+import tempfile
+from functools import lru_cache
+from operator import attrgetter
 from pydub import AudioSegment
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from difflib import SequenceMatcher
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+# rapidfuzz is optional, it is only used for title matching when requested
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:
+    process = None  # type: ignore[assignment]
 
 # Dictionary for transliteration of special characters to ASCII equivalents
 SPECIAL_CHAR_MAP = {
@@ -24,65 +36,213 @@ SPECIAL_CHAR_MAP = {
     # Add more mappings as needed
 }
 
+# Translation table built from SPECIAL_CHAR_MAP for str.translate
+_SPECIAL_CHAR_TABLE = str.maketrans(SPECIAL_CHAR_MAP)
+
+# Precompiled patterns used while parsing and cleaning file names
+_FOLGE_RE = re.compile(r"Folge\s*(\d+)")
+_NUMBERS_RE = re.compile(r"Folge\s*(\d+)|(?:Kapitel|Teil)\s*(\d+)")
+_TITLE_RE = re.compile(r"([a-zA-Z0-9\s]+)(\d+|\.mp3|\.mp4|\.pdf)?$")
+_STRIP_RE = re.compile(r"Folge\s*\d+|\s*\(.*?\)|\s*\[.*?\]")
+_KT_STRIP_RE = re.compile(r"(?:Kapitel|Teil)\s*\d+")
+_SEPARATOR_RE = re.compile(r"[ _-]+")
+
+class FileRecord(NamedTuple):
+    """
+    An MP3 file with the numbers parsed from its name.
+    """
+    folge_number: str
+    kapitel_or_teil_number: int
+    path: str
+    name: str  # file name without directory and extension
+
+# Upper bound for parallel merges, each decoding merge holds a whole audiobook in memory
+MAX_MERGE_WORKERS = min(4, os.cpu_count() or 1)
+
 # Global counter for Folge numbers
 folge_counter = 1
 
-def replace_special_characters(text):
+def replace_special_characters(text: str) -> str:
     """
     Replace special characters in the text using the SPECIAL_CHAR_MAP.
     """
-    for char, replacement in SPECIAL_CHAR_MAP.items():
-        text = text.replace(char, replacement)
-    return text
+    return text.translate(_SPECIAL_CHAR_TABLE)
 
-def extract_kapitel_or_teil_number(filename):
+def parse_file_name(filename: str) -> Tuple[str, int]:
     """
-    Extracts the Kapitel or Teil number from the filename.
-    If neither is found, return 0.
+    Extracts the Folge and the Kapitel or Teil number from the filename in one scan.
+    If no Folge is found, return "000"; if neither Kapitel nor Teil is found, return 0.
     """
-    kapitel_match = re.search(r"(Kapitel|Teil)\s*(\d+)", filename)
-    return int(kapitel_match.group(2)) if kapitel_match else 0
+    folge_number: Optional[str] = None
+    kapitel_or_teil_number: Optional[int] = None
 
-def extract_title(filename):
+    for match in _NUMBERS_RE.finditer(filename):
+        if match.group(1) is not None:
+            if folge_number is None:
+                folge_number = match.group(1)
+        elif kapitel_or_teil_number is None:
+            kapitel_or_teil_number = int(match.group(2))
+
+        if folge_number is not None and kapitel_or_teil_number is not None:
+            break
+
+    return (folge_number if folge_number is not None else "000",
+            kapitel_or_teil_number if kapitel_or_teil_number is not None else 0)
+
+def extract_title(filename: str) -> str:
     """
     Extract the title from the filename (before any number or extension).
     """
     # Assuming the title is everything before a number or file extension
-    match = re.match(r"([a-zA-Z0-9\s]+)(\d+|\.mp3|\.mp4|\.pdf)?$", filename)
+    match = _TITLE_RE.match(filename)
     return match.group(1) if match else filename
 
-def similar(a, b):
+@lru_cache(maxsize=1024)
+def get_title_matcher(title: str) -> SequenceMatcher:
+    """
+    Returns a SequenceMatcher with the title as its second sequence.
+    The matcher is reused so its index of the title is only built once.
+    Autojunk is disabled, it skews the ratio for repetitive file names.
+    """
+    return SequenceMatcher(None, "", title, autojunk=False)
+
+def similar(a: str, b: str) -> float:
     """
     Function to calculate similarity ratio between two strings.
     """
-    return SequenceMatcher(None, a, b).ratio()
+    matcher = get_title_matcher(b)
+    matcher.set_seq1(a)
+    return matcher.ratio()
 
-def merge_mp3_files(mp3_files, output_file):
+def find_similar_title(title: str, candidates: Sequence[str],
+                       similarity_threshold: float, use_rapidfuzz: bool = False) -> Optional[str]:
     """
-    Merges multiple MP3 files into a single MP3 file.
+    Returns a candidate whose similarity to the title exceeds the threshold.
+    By default this is the first candidate above the threshold by similar().
+    With use_rapidfuzz it is the best scoring candidate by rapidfuzz's fuzz.ratio,
+    a different metric, so the resulting groups can differ.
     """
-    # Load the first file
-    combined = AudioSegment.from_mp3(mp3_files[0])
+    if use_rapidfuzz:
+        if process is None:
+            raise ImportError("use_rapidfuzz requires the rapidfuzz package")
+        score_cutoff = similarity_threshold * 100
+        match = process.extractOne(
+            title, candidates, scorer=fuzz.ratio,
+            processor=None, score_cutoff=score_cutoff
+        )
+        # score_cutoff also accepts equal scores, the threshold must be exceeded
+        if match is None or match[1] == score_cutoff:
+            return None
+        return match[0]
 
-    # Append the rest of the files
+    for candidate in candidates:
+        if similar(title, candidate) > similarity_threshold:
+            return candidate
+    return None
+
+def get_stream_format(mp3_file: str) -> Optional[Tuple[str, ...]]:
+    """
+    Returns the (sample_fmt, sample_rate, channels) of an MP3 file using ffprobe.
+    Only the stream metadata is read, the audio is not decoded.
+    If the file cannot be probed, return None.
+    """
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=sample_rate,channels,sample_fmt",
+             "-of", "csv=p=0", mp3_file],
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    # csv output lists the entries in ffprobe's field order, not in the requested order
+    fields = result.stdout.strip().split(",")
+    if len(fields) != 3:
+        return None
+    return tuple(fields)
+
+def concat_mp3_files(mp3_files: List[str], output_file: str) -> None:
+    """
+    Concatenates MP3 files without re-encoding using the ffmpeg concat demuxer.
+    """
+    # Write the list of input files in the format of the concat demuxer
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", encoding="utf-8", delete=False) as list_file:
+        for mp3 in mp3_files:
+            path = os.path.abspath(mp3).replace("'", "'\\''")
+            list_file.write(f"file '{path}'\n")
+
+    try:
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0",
+             "-i", list_file.name, "-c", "copy", output_file],
+            check=True
+        )
+    finally:
+        os.remove(list_file.name)
+
+def decode_and_merge_mp3_files(mp3_files: List[str], output_file: str) -> None:
+    """
+    Decodes multiple MP3 files and encodes them into a single MP3 file.
+    """
+    # Load the first file; its format defines the format of the result
+    first = AudioSegment.from_mp3(mp3_files[0])
+    sample_width, frame_rate, channels = first.sample_width, first.frame_rate, first.channels
+    samples = bytearray(first.raw_data)
+    del first
+
+    # Append the raw samples of the rest of the files to a single buffer
     for mp3 in mp3_files[1:]:
         next_audio = AudioSegment.from_mp3(mp3)
-        combined += next_audio
+
+        # Convert to the format of the first file if necessary
+        if next_audio.frame_rate != frame_rate:
+            next_audio = next_audio.set_frame_rate(frame_rate)
+        if next_audio.channels != channels:
+            next_audio = next_audio.set_channels(channels)
+        if next_audio.sample_width != sample_width:
+            next_audio = next_audio.set_sample_width(sample_width)
+
+        samples += next_audio.raw_data
+
+    # Build the combined audio once; AudioSegment keeps the bytearray without copying it
+    combined = AudioSegment(
+        data=samples,
+        sample_width=sample_width,
+        frame_rate=frame_rate,
+        channels=channels,
+    )
+    del samples
 
     # Export the combined audio to a new MP3 file
     combined.export(output_file, format="mp3")
+
+def merge_mp3_files(mp3_files: List[str], output_file: str) -> None:
+    """
+    Merges multiple MP3 files into a single MP3 file.
+    Files that share their stream format are copied without re-encoding.
+    """
+    stream_formats = {get_stream_format(mp3) for mp3 in mp3_files}
+
+    if len(stream_formats) == 1 and None not in stream_formats:
+        concat_mp3_files(mp3_files, output_file)
+    else:
+        decode_and_merge_mp3_files(mp3_files, output_file)
+
     print(f"Merged audio saved as {output_file}")
 
-def clean_file_name(filename):
+def clean_file_name(filename: str, folge_number: Optional[str] = None) -> str:
     """
     Cleans the filename to match the desired format.
     If the Folge number starts with '000', it will increment.
+    An already extracted Folge number can be passed to skip searching for it.
     """
     global folge_counter
 
     # Extract "Folge <number>" regardless of position
-    folge_match = re.search(r"Folge\s*(\d+)", filename)
-    folge_number = folge_match.group(1) if folge_match else "000"
+    if folge_number is None:
+        folge_match = _FOLGE_RE.search(filename)
+        folge_number = folge_match.group(1) if folge_match else "000"
 
     # If the Folge number is "000", increment the counter for each new file processed
     if folge_number == "000":
@@ -93,20 +253,16 @@ def clean_file_name(filename):
         folge_number = folge_number.zfill(3)
 
     # Remove "Folge <number>" and any content inside parentheses/brackets
-    filename = re.sub(r"Folge\s*\d+|\s*\(.*?\)|\s*\[.*?\]", "", filename)
+    filename = _STRIP_RE.sub("", filename)
     
     # Remove common prefixes like "Kapitel" and "Teil"
-    filename = re.sub(r"(Kapitel|Teil)\s*\d+", "", filename)
-    
-    # Replace spaces with underscores
-    filename = filename.replace(" ", "_")
+    filename = _KT_STRIP_RE.sub("", filename)
     
     # Replace special characters with safe equivalents
     filename = replace_special_characters(filename)
     
-    # Remove any double underscores
-    filename = re.sub(r"-+", "_", filename)
-    filename = re.sub(r"_+", "_", filename)
+    # Replace runs of spaces, dashes and underscores with a single underscore
+    filename = _SEPARATOR_RE.sub("_", filename)
     
     # Strip leading/trailing underscores
     filename = filename.strip("_")
@@ -116,53 +272,75 @@ def clean_file_name(filename):
     
     return cleaned
 
-def group_files_by_similarity(directory, similarity_threshold=0.9):
+def lengths_allow_similarity(a: str, b: str, similarity_threshold: float) -> bool:
+    """
+    Returns False if the lengths alone rule out a similarity above the threshold.
+    The similarity ratio of two strings never exceeds 2 * min(la, lb) / (la + lb).
+    """
+    total = len(a) + len(b)
+    if total == 0:
+        return True
+    return 2 * min(len(a), len(b)) / total > similarity_threshold
+
+def group_files_by_similarity(directory: str, similarity_threshold: float = 0.9,
+                              use_rapidfuzz: bool = False) -> Dict[str, List[FileRecord]]:
     """
     Groups files by their title similarity.
+    Each file is stored as a FileRecord.
+    See find_similar_title for use_rapidfuzz.
     """
-    groups = defaultdict(list)
+    groups: Dict[str, List[FileRecord]] = defaultdict(list)
     
     # Traverse through the folder and classify files
-    for filename in os.listdir(directory):
-        if filename.endswith(".mp3"):
-            title = extract_title(filename)
-            added = False
-            
-            # Check against existing groups
-            for group_title in list(groups.keys()):
-                if similar(title, group_title) > similarity_threshold:
-                    groups[group_title].append(os.path.join(directory, filename))
-                    added = True
-                    break
-            
-            # If not added to any group, create a new group
-            if not added:
-                groups[title].append(os.path.join(directory, filename))
+    with os.scandir(directory) as entries:
+        mp3_entries = [entry for entry in entries
+                       if entry.name.endswith(".mp3") and entry.is_file()]
+
+    splitext = os.path.splitext
+    for entry in mp3_entries:
+        name = entry.name
+        title = extract_title(name)
+        folge_number, kapitel_or_teil_number = parse_file_name(name)
+        record = FileRecord(folge_number, kapitel_or_teil_number, entry.path, splitext(name)[0])
+
+        # Skip group titles whose length already rules out a match
+        candidates = [group_title for group_title in groups
+                      if lengths_allow_similarity(title, group_title, similarity_threshold)]
+        
+        # Check against the remaining existing groups
+        group_title = find_similar_title(title, candidates, similarity_threshold, use_rapidfuzz)
+        
+        # If not added to any group, create a new group
+        if group_title is None:
+            groups[title].append(record)
+        else:
+            groups[group_title].append(record)
     
     return groups
 
-def merge_files_in_directory(directory):
+def merge_files_in_directory(directory: str, max_workers: int = MAX_MERGE_WORKERS,
+                             use_rapidfuzz: bool = False) -> None:
     """
     Merge files in the directory by similarity in title.
+    Up to max_workers groups are merged in parallel.
     """
-    file_groups = group_files_by_similarity(directory)
+    file_groups = group_files_by_similarity(directory, use_rapidfuzz=use_rapidfuzz)
+    merge_jobs: List[Tuple[List[str], str]] = []
+    output_files = set()
     
     # For each group of files with similar titles, merge them
-    for group_title, files in file_groups.items():
+    for group_title, records in file_groups.items():
 
-        # Extract Kapitel or Teil numbers and sort files accordingly
-        files_with_kapitel_or_teil = [(extract_kapitel_or_teil_number(os.path.basename(f)), f) for f in files]
-        
-        # Remove duplicates by using a set to avoid double counting of the same Kapitel/Teil
-        seen = set()
-        unique_files = []
-        for number, file in files_with_kapitel_or_teil:
-            if number not in seen:
-                unique_files.append((number, file))
-                seen.add(number)
+        # Key the files by their parsed Kapitel or Teil number, keeping the first
+        # file per number to avoid double counting of the same Kapitel/Teil
+        files_by_kapitel_or_teil: Dict[int, FileRecord] = {}
+        for record in records:
+            files_by_kapitel_or_teil.setdefault(record.kapitel_or_teil_number, record)
         
-        unique_files.sort()  # Sort by Kapitel/Teil number
-        kapitel_or_teil_numbers = [entry[0] for entry in unique_files]
+        # Sort by Kapitel/Teil number only
+        unique_files = sorted(files_by_kapitel_or_teil.values(),
+                              key=attrgetter("kapitel_or_teil_number"))
+        kapitel_or_teil_numbers = [record.kapitel_or_teil_number for record in unique_files]
         
         # Check for start with 1
         if kapitel_or_teil_numbers[0] != 1:
@@ -174,35 +352,50 @@ def merge_files_in_directory(directory):
             print(f"Warning: Group '{group_title}' has only one Kapitel/Teil.")
             continue
 
-        # Check for gaps in Kapitel/Teil numbers
-        gap_detected = False
-        for i in range(1, len(kapitel_or_teil_numbers)):
-            if kapitel_or_teil_numbers[i] != kapitel_or_teil_numbers[i-1] + 1:
-                gap_detected = True
-        if gap_detected:
+        # Check for gaps in Kapitel/Teil numbers, they must run from 1 to N
+        if kapitel_or_teil_numbers != list(range(1, len(kapitel_or_teil_numbers) + 1)):
             print(f"Warning: Gap detected in Kapitel/Teil order for group '{group_title}'.")
             continue
         
-        # Get the name of the first file (base name without directory)
-        first_file_name = os.path.basename(unique_files[0][1])
-        first_file_name_without_extension = os.path.splitext(first_file_name)[0]
+        # Get the first file (name without directory and extension)
+        first_record = unique_files[0]
         
         # Clean the name to match the desired format
-        cleaned_name = clean_file_name(first_file_name_without_extension)
+        cleaned_name = clean_file_name(first_record.name, first_record.folge_number)
         
         # Construct the output file name
         output_file = os.path.join(directory, f"{cleaned_name}.mp3")
         
-        # Merge files in the sorted order
-        sorted_files = [f[1] for f in unique_files]
-        merge_mp3_files(sorted_files, output_file)
-
-# Prompt the user for the directory containing MP3 files
-directory = input("Enter the folder path containing MP3 files: ").strip()
-
-# Check if the directory exists
-if not os.path.isdir(directory):
-    print("Error: The specified folder does not exist.")
-else:
-    # Call the function to merge files
-    merge_files_in_directory(directory)
+        # Parallel merges must not write the same file
+        if output_file in output_files:
+            print(f"Warning: Group '{group_title}' would overwrite {output_file}, skipping it.")
+            continue
+        output_files.add(output_file)
+        
+        # Queue the files in the sorted order for merging
+        sorted_files = [record.path for record in unique_files]
+        merge_jobs.append((sorted_files, output_file))
+
+    # Groups are independent, so merge them in parallel processes
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(merge_mp3_files, files, output_file)
+                   for files, output_file in merge_jobs]
+        for future in futures:
+            future.result()
+
+def main() -> None:
+    """
+    Prompt for a folder and merge the MP3 files in it.
+    """
+    # Prompt the user for the directory containing MP3 files
+    directory = input("Enter the folder path containing MP3 files: ").strip()
+
+    # Check if the directory exists
+    if not os.path.isdir(directory):
+        print("Error: The specified folder does not exist.")
+    else:
+        # Call the function to merge files
+        merge_files_in_directory(directory)
+
+if __name__ == "__main__":
+    main()